@@ -1,6 +1,60 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
+import hashlib
 import io
+import os
+import tempfile
+import xlsxwriter
+
+# --- Excel Read Engine ---
+# python-calamine parses uploads far faster than openpyxl; fall back to
+# openpyxl on deployments where it isn't installed.
+try:
+    import python_calamine  # noqa: F401
+    EXCEL_READ_ENGINE = "calamine"
+except ImportError:
+    EXCEL_READ_ENGINE = "openpyxl"
+
+# --- Function to read an uploaded Excel file ---
+def read_uploaded_excel(file, dtype=None, usecols=None):
+    """Reads the first sheet of an uploaded .xlsx file into a DataFrame.
+
+    If usecols is given, only those columns are read; any that are missing are
+    simply absent from the result so the caller can report them.
+    """
+    # Spool the upload to disk so the engine reads from a file path instead of
+    # copying the in-memory upload stream again
+    tf = tempfile.NamedTemporaryFile(suffix='.xlsx', delete=False)
+    try:
+        with tf:
+            tf.write(file.getbuffer())
+        return pd.read_excel(
+            tf.name,
+            dtype=dtype,
+            usecols=None if usecols is None else lambda col: col in usecols,
+            engine=EXCEL_READ_ENGINE,
+        )
+    finally:
+        os.unlink(tf.name)
+
+# --- Function to make sheet names unique ---
+def make_unique_sheet_names(names):
+    """Suffixes repeated sheet names with a number, as openpyxl does.
+
+    Excel compares sheet names without regard to case, so 'East' and 'east'
+    become 'East' and 'east1'. Suffixed names stay within 31 characters.
+    """
+    used_names = set()
+    unique_names = []
+    for name in names:
+        unique_name, suffix = name, 1
+        while unique_name.lower() in used_names:
+            unique_name = f"{name[:31 - len(str(suffix))]}{suffix}"
+            suffix += 1
+        used_names.add(unique_name.lower())
+        unique_names.append(unique_name)
+    return unique_names
 
 # --- Streamlit Page Configuration ---
 st.set_page_config(
@@ -11,8 +65,9 @@ st.set_page_config(
 )
 
 # --- Function to create Excel templates in memory ---
+@st.cache_data(show_spinner=False)
 def create_template_files():
-    """Creates two in-memory Excel files for user download."""
+    """Creates two in-memory Excel files for user download, cached across reruns."""
     
     # --- Template 1: Items Spreadsheet ---
     items_data = {
@@ -27,7 +82,6 @@ def create_template_files():
     items_buffer = io.BytesIO()
     with pd.ExcelWriter(items_buffer, engine='openpyxl') as writer:
         df_items_template.to_excel(writer, sheet_name='Items', index=False)
-    items_buffer.seek(0)
 
     # --- Template 2: Region Patches Spreadsheet ---
     patches_data = {
@@ -42,9 +96,9 @@ def create_template_files():
     patches_buffer = io.BytesIO()
     with pd.ExcelWriter(patches_buffer, engine='openpyxl') as writer:
         df_patches_template.to_excel(writer, sheet_name='Region_Patches', index=False)
-    patches_buffer.seek(0)
     
-    return items_buffer, patches_buffer
+    # Return bytes so the cached value is immutable and can be served repeatedly
+    return items_buffer.getvalue(), patches_buffer.getvalue()
 
 # --- Main Application ---
 st.title("Automated Data Pairing and Export Tool")
@@ -59,21 +113,21 @@ This tool intelligently pairs items with their regional patch codes and exports
 """)
 
 # --- Template Download Section ---
-items_template_buffer, patches_template_buffer = create_template_files()
+items_template_bytes, patches_template_bytes = create_template_files()
 
 with st.expander("⬇️ Click here to download template files"):
     st.markdown("Use these templates to ensure your data is in the correct format.")
     
     st.download_button(
         label="Download Items Template (.xlsx)",
-        data=items_template_buffer,
+        data=items_template_bytes,
         file_name="template_items.xlsx",
         mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
     )
     
     st.download_button(
         label="Download Region Patches Template (.xlsx)",
-        data=patches_template_buffer,
+        data=patches_template_bytes,
         file_name="template_region_patches.xlsx",
         mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
     )
@@ -89,53 +143,120 @@ if file1 and file2:
     try:
         st.header("2. Processing and Generating Output")
 
-        # --- Data Loading ---
-        df_items = pd.read_excel(file1, dtype={'VBU': str})
-        df_regions_wide = pd.read_excel(file2)
-
-        # --- Data Validation ---
-        required_item_cols = {'Item #', 'Model', 'VBU', 'Region'}
-        if not required_item_cols.issubset(df_items.columns):
-            st.error(f"Error: The Items spreadsheet must contain the following columns: {', '.join(required_item_cols)}")
-            st.stop()
-
-        if df_regions_wide.empty:
-            st.error("Error: The Region Patches spreadsheet cannot be empty.")
-            st.stop()
-
-        # --- Data Transformation for Regions Spreadsheet ---
-        st.write("Transforming Region Patches data...")
-        df_regions_long = pd.melt(df_regions_wide, var_name='Region', value_name='Region patch code')
-        df_regions_long.dropna(subset=['Region patch code'], inplace=True)
-        
-        # --- Region-Based Pairing (Merge) ---
-        st.write("Pairing items with patch codes based on matching regions...")
-        df_merged = pd.merge(df_items, df_regions_long, on='Region', how='left')
-        df_merged.dropna(subset=['Region patch code'], inplace=True)
-
-        # --- Structure the Output ---
-        output_df = df_merged[['VBU', 'Item #', 'Model', 'Region patch code', 'Region']]
-        
-        st.success("Data has been successfully paired and structured!")
-        st.write("Preview of the first 20 paired rows:")
-        st.dataframe(output_df.head(20))
+        # Reruns with the same uploads reuse the previous result instead of reprocessing
+        upload_key = (
+            hashlib.md5(file1.getbuffer(), usedforsecurity=False).digest(),
+            hashlib.md5(file2.getbuffer(), usedforsecurity=False).digest(),
+        )
+        if st.session_state.get('cache_key') != upload_key:
+            # --- Data Loading ---
+            required_item_cols = {'Item #', 'Model', 'VBU', 'Region'}
+            # Text identifiers are read as strings, skipping numeric and date inference;
+            # Item # keeps its inferred type so it is written back as a number
+            item_text_cols = ['VBU', 'Model', 'Region']
+            df_items = read_uploaded_excel(file1, dtype=dict.fromkeys(item_text_cols, str), usecols=required_item_cols)
+            df_regions_wide = read_uploaded_excel(file2, dtype=str)
 
-        # --- Excel Export Preparation ---
-        st.header("3. Download Your File")
+            # --- Data Validation ---
+            missing_item_cols = required_item_cols - set(df_items.columns)
+            if missing_item_cols:
+                st.error(f"Error: The Items spreadsheet is missing the following columns: {', '.join(sorted(missing_item_cols))}")
+                st.stop()
+
+            if df_regions_wide.empty:
+                st.error("Error: The Region Patches spreadsheet cannot be empty.")
+                st.stop()
+
+            # Arrow-backed strings keep text columns in contiguous native buffers
+            df_items = df_items.astype(dict.fromkeys(item_text_cols, 'string[pyarrow]'))
+            df_regions_wide = df_regions_wide.astype('string[pyarrow]')
+            # Headers are region names too, so compare them as text like the items' Region
+            df_regions_wide.columns = df_regions_wide.columns.astype(str)
 
-        output_buffer = io.BytesIO()
-        with pd.ExcelWriter(output_buffer, engine='openpyxl') as writer:
-            for region_name, group_df in output_df.groupby('Region'):
-                final_tab_df = group_df[['VBU', 'Item #', 'Model', 'Region patch code']]
-                sheet_name = str(region_name)[:31]
-                final_tab_df.to_excel(writer, sheet_name=sheet_name, index=False)
-        
-        output_buffer.seek(0)
+            # --- Data Transformation for Regions Spreadsheet ---
+            st.write("Transforming Region Patches data...")
+            # Each region's patch codes, gathered once rather than joined per item
+            patches_by_region = {
+                region: df_regions_wide[region].dropna().to_numpy() for region in df_regions_wide.columns
+            }
+
+            # --- Region-Based Pairing ---
+            st.write("Pairing items with patch codes based on matching regions...")
+            region_dtype = pd.CategoricalDtype(
+                pd.Index(df_items['Region'].dropna().unique()).union(df_regions_wide.columns)
+            )
+            df_items['Region'] = df_items['Region'].astype(region_dtype)
+
+            # Look up patch codes by category code; the trailing empty slot is picked
+            # up by code -1, i.e. items without a Region
+            no_patches = np.array([], dtype=object)
+            patches_by_code = np.empty(len(region_dtype.categories) + 1, dtype=object)
+            for code, region in enumerate(region_dtype.categories):
+                patches_by_code[code] = patches_by_region.get(region, no_patches)
+            patches_by_code[-1] = no_patches
+
+            df_items['Region patch code'] = patches_by_code[df_items['Region'].cat.codes.to_numpy()]
+            df_paired = df_items.explode('Region patch code', ignore_index=True)
+            has_patch = df_paired['Region patch code'].notna().to_numpy()
+            df_paired = df_paired.iloc[has_patch].reset_index(drop=True)
+            df_paired['Region patch code'] = df_paired['Region patch code'].astype('string[pyarrow]')
+
+            if df_paired.empty:
+                st.error("Error: No items could be paired. Make sure the items' Region values match the Region Patches column headers.")
+                st.stop()
+
+            # --- Structure the Output ---
+            # The written frame omits Region; sheets are split using the sorted region codes.
+            # It is built from the reordered column arrays directly, which avoids the block
+            # consolidation and second copy of a column projection followed by iloc.
+            region_codes = df_paired['Region'].cat.codes.to_numpy()
+            order = np.argsort(region_codes, kind='stable')
+            write_df = pd.DataFrame(
+                {col: df_paired[col].array.take(order) for col in ['VBU', 'Item #', 'Model', 'Region patch code']},
+                copy=False
+            )
+            region_codes = region_codes[order]
+            group_codes, group_starts = np.unique(region_codes, return_index=True)
+            group_ends = np.append(group_starts[1:], len(region_codes))
+
+            # --- Excel Export Preparation ---
+            # constant_memory mode flushes each row as it is written instead of retaining it.
+            # Rows must be written in order, so cells are written here rather than via
+            # to_excel, which emits them column by column.
+            # Sheet names are truncated to Excel's 31-character limit in one vectorized pass
+            sheet_names = make_unique_sheet_names(
+                region_dtype.categories[group_codes].astype(str).str.slice(0, 31).tolist()
+            )
+            output_buffer = io.BytesIO()
+            with xlsxwriter.Workbook(output_buffer, {'constant_memory': True}) as wb:
+                for sheet_name, start, end in zip(sheet_names, group_starts, group_ends):
+                    ws = wb.add_worksheet(sheet_name)
+                    ws.write_row(0, 0, write_df.columns)
+                    # Missing values are written as empty cells, as to_excel does. The object
+                    # copy is made per region so only one slice is materialized at a time.
+                    group_df = write_df.iloc[start:end]
+                    group_rows = group_df.astype(object).where(group_df.notna(), None).itertuples(
+                        index=False, name=None
+                    )
+                    for row_idx, row in enumerate(group_rows, start=1):
+                        ws.write_row(row_idx, 0, row)
+            output_data = output_buffer.getvalue()
+
+            preview_df = df_paired.head(20)[['VBU', 'Item #', 'Model', 'Region patch code', 'Region']]
+            st.session_state['cache'] = (preview_df, output_data)
+            st.session_state['cache_key'] = upload_key
+
+        preview_df, output_data = st.session_state['cache']
+
+        st.success("Data has been successfully paired and structured!")
+        st.write("Preview of the first 20 paired rows:")
+        st.dataframe(preview_df)
 
         # --- Download Button for Processed File ---
+        st.header("3. Download Your File")
         st.download_button(
             label="⬇️ Download Paired Data as Excel File",
-            data=output_buffer,
+            data=output_data,
             file_name="region_paired_output.xlsx",
             mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
         )